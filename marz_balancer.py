@@ -1,16 +1,20 @@
 import os
+import re
+import socket
 import time
 import asyncio
-import subprocess
-import re
-from typing import Dict, Any, Optional, List
+import functools
+import itertools
+from typing import Dict, Any, Optional, List, Set, Tuple
 from contextlib import asynccontextmanager
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from html import escape
 
 import aiohttp
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, Response
 
 load_dotenv()
 
@@ -19,10 +23,21 @@ MARZBAN_ADMIN_USER = os.getenv("MARZBAN_ADMIN_USER", "")
 MARZBAN_ADMIN_PASS = os.getenv("MARZBAN_ADMIN_PASS", "")
 POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "5"))
 APP_PORT = int(os.getenv("APP_PORT", "8023"))
+APP_RELOAD = os.getenv("APP_RELOAD", "").strip().lower() in ("1", "true", "yes")
 IP_AGENT_PORT = os.getenv("IP_AGENT_PORT", "").strip()
 IP_AGENT_SCHEME = os.getenv("IP_AGENT_SCHEME", "http").strip()
 
 MONITOR_PORT = int(os.getenv("MONITOR_PORT", "8443"))
+IP_AGENT_CONN_LIMIT = int(os.getenv("IP_AGENT_CONN_LIMIT", "200"))
+NODE_CONCURRENCY = int(os.getenv("NODE_CONCURRENCY", "16"))
+# часть интервала опроса, отведённая на опрос всех нод; одна нода не может ждать дольше всего опроса
+_NODE_POLL_BUDGET = POLL_INTERVAL * 0.8
+NODE_TIMEOUT = min(float(os.getenv("NODE_TIMEOUT", "4")), _NODE_POLL_BUDGET)
+
+NODES_USAGE_INTERVAL = float(os.getenv("NODES_USAGE_INTERVAL", "30"))
+USERS_USAGE_INTERVAL = float(os.getenv("USERS_USAGE_INTERVAL", "30"))
+_NODES_USAGE_EVERY = max(1, round(NODES_USAGE_INTERVAL / POLL_INTERVAL))
+_USERS_USAGE_EVERY = max(1, round(USERS_USAGE_INTERVAL / POLL_INTERVAL))
 
 NODE_CANDIDATE_PATHS = [
     "/connections",
@@ -30,6 +45,30 @@ NODE_CANDIDATE_PATHS = [
     "/status",
 ]
 
+# данные нод могут содержать нестроковые ключи, stdlib json их приводит к строкам — делаем так же
+_ORJSON_OPTS = orjson.OPT_NON_STR_KEYS
+
+_T5 = aiohttp.ClientTimeout(total=5)
+_T10 = aiohttp.ClientTimeout(total=10)
+_T15 = aiohttp.ClientTimeout(total=15)
+_T20 = aiohttp.ClientTimeout(total=20)
+# сколько ждать путь, найденный на прошлом опросе, прежде чем перебирать остальные
+_CACHED_PATH_TIMEOUT = 2.0
+
+_NODE_HEADERS = {"Accept": "application/json"}
+
+# ключи, под которыми ip_agent и совместимые сервисы отдают список клиентов
+_LIST_KEYS = ("clients", "connections", "peers", "addresses")
+# служебные поля ответа ip_agent, которые прокидываются в clients_meta
+_META_KEYS = ("count_ipv4_enabled", "count_ipv6_enabled", "trusted_ips_configured")
+
+_PROC_NET_TCP = (("/proc/net/tcp", socket.AF_INET), ("/proc/net/tcp6", socket.AF_INET6))
+# как у "ss state connected": всё, кроме LISTEN (0A) и CLOSE (07)
+_PROC_TCP_SKIP_STATES = (b"07", b"0A")
+
+# адрес собеседника — последняя колонка строки ss: "1.2.3.4:5555" или "[2001:db8::1]:5555"
+_PEER_RE = re.compile(rb"\s\[?([^\s\[\]]+?)\]?:\d+[ \t]*$", re.MULTILINE)
+
 # runtime state
 stats: Dict[str, Any] = {
     "nodes": [],
@@ -40,322 +79,474 @@ stats: Dict[str, Any] = {
     "users_usage": None,
     "port_8443": {"unique_clients": 0, "clients": []},
 }
-_token_cache: Dict[str, Any] = {"token": None, "fetched_at": 0, "ttl": 300}
-
-async def _fetch_token(session: aiohttp.ClientSession) -> Optional[str]:
-    if not MARZBAN_URL or not MARZBAN_ADMIN_USER or not MARZBAN_ADMIN_PASS:
-        return None
-    now = time.time()
-    if _token_cache["token"] and now - _token_cache["fetched_at"] < _token_cache["ttl"]:
-        return _token_cache["token"]
+# fetched_at/failed_at считаются по time.monotonic(), чтобы TTL не зависел от перевода системных часов
+_token_cache: Dict[str, Any] = {"token": None, "fetched_at": 0, "ttl": 300, "refresh_task": None, "failed_at": 0, "retry_after": 1}
+_token_lock = asyncio.Lock()
+_NODE_SEM = asyncio.Semaphore(NODE_CONCURRENCY)
+_detected_path_cache: Dict[Any, Tuple[str, str, str]] = {}
+_node_rotation: Dict[str, int] = {"offset": 0}
+# эндпоинты статистики, чей последний опрос не удался: их повторяем в следующем цикле, не дожидаясь интервала
+_usage_retry: Set[str] = set()
+_html_cache: Dict[str, Any] = {"last_update": None, "html": ""}
+_stats_json_cache: Dict[str, bytes] = {"body": b""}
+_range_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+_conditional_cache: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Tuple[Optional[str], Optional[str], Any]] = {}
+
+async def _request_token(session: aiohttp.ClientSession) -> Optional[str]:
     url = f"{MARZBAN_URL}/api/admin/token"
     data = {"username": MARZBAN_ADMIN_USER, "password": MARZBAN_ADMIN_PASS}
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    token = None
     try:
-        async with session.post(url, data=data, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-            if resp.status != 200:
-                return None
-            j = await resp.json()
-            token = j.get("access_token") or j.get("token")
-            if token:
-                _token_cache["token"] = token
-                _token_cache["fetched_at"] = now
-                return token
+        async with session.post(url, data=data, headers=headers, timeout=_T10) as resp:
+            if resp.status == 200:
+                j = await resp.json()
+                token = j.get("access_token") or j.get("token")
     except Exception:
-        return None
-    return None
+        token = None
+    if token:
+        _token_cache["token"] = token
+        _token_cache["fetched_at"] = time.monotonic()
+    else:
+        _token_cache["failed_at"] = time.monotonic()
+    return token
 
-async def _fetch_nodes(session: aiohttp.ClientSession, token: Optional[str]) -> Optional[List[Dict[str, Any]]]:
-    if not MARZBAN_URL:
+async def _refresh_token(session: aiohttp.ClientSession) -> None:
+    async with _token_lock:
+        if time.monotonic() - _token_cache["fetched_at"] < _token_cache["ttl"] * 0.8:
+            return
+        await _request_token(session)
+
+async def _fetch_token(session: aiohttp.ClientSession) -> Optional[str]:
+    if not MARZBAN_URL or not MARZBAN_ADMIN_USER or not MARZBAN_ADMIN_PASS:
         return None
-    headers = {}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    url = f"{MARZBAN_URL}/api/nodes"
-    try:
-        async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-            if resp.status != 200:
-                return None
-            return await resp.json()
-    except Exception:
+    age = time.monotonic() - _token_cache["fetched_at"]
+    if _token_cache["token"] and age < _token_cache["ttl"]:
+        # токен скоро истечёт — обновляем в фоне, текущий пока остаётся рабочим
+        task = _token_cache["refresh_task"]
+        if age > _token_cache["ttl"] * 0.8 and (task is None or task.done()):
+            _token_cache["refresh_task"] = asyncio.create_task(_refresh_token(session))
+        return _token_cache["token"]
+    async with _token_lock:
+        now = time.monotonic()
+        if _token_cache["token"] and now - _token_cache["fetched_at"] < _token_cache["ttl"]:
+            return _token_cache["token"]
+        # master только что не выдал токен — не долбим его повторно, пока не пройдёт retry_after
+        if now - _token_cache["failed_at"] < _token_cache["retry_after"]:
+            return None
+        return await _request_token(session)
+
+@functools.lru_cache(maxsize=4)
+def _auth_headers(token: Optional[str]) -> Dict[str, str]:
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+async def _authed_get(session: aiohttp.ClientSession, path: str, token: Optional[str], params: Optional[Dict[str, str]] = None, timeout: aiohttp.ClientTimeout = _T10) -> Optional[Any]:
+    if not MARZBAN_URL:
         return None
+    # если master отдаёт ETag/Last-Modified, переспрашиваем условно и на 304 берём прошлый ответ без разбора
+    key = (path, tuple(sorted(params.items())) if params else ())
+    cached = _conditional_cache.get(key)
+    headers = _auth_headers(token)
+    if cached:
+        headers = dict(headers)
+        if cached[0]:
+            headers["If-None-Match"] = cached[0]
+        if cached[1]:
+            headers["If-Modified-Since"] = cached[1]
+    async with session.get(f"{MARZBAN_URL}{path}", headers=headers, params=params, timeout=timeout) as resp:
+        if resp.status == 304 and cached:
+            return cached[2]
+        if resp.status != 200 or resp.content_length == 0:
+            return None
+        # ответы usage бывают в несколько МБ: разбираем байты напрямую, без промежуточной строки
+        payload = orjson.loads(await resp.read())
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        if etag or last_modified:
+            _conditional_cache[key] = (etag, last_modified, payload)
+        else:
+            _conditional_cache.pop(key, None)
+        return payload
+
+def _range_params(start: Optional[str], end: Optional[str]) -> Dict[str, str]:
+    return {k: v for k, v in (("start", start), ("end", end)) if v}
+
+async def _fetch_nodes(session: aiohttp.ClientSession, token: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+    return await _authed_get(session, "/api/nodes", token)
 
 async def _fetch_system(session: aiohttp.ClientSession, token: Optional[str]) -> Optional[Dict[str, Any]]:
-    if not MARZBAN_URL:
-        return None
-    headers = {}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    url = f"{MARZBAN_URL}/api/system"
-    try:
-        async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-            if resp.status != 200:
-                return None
-            return await resp.json()
-    except Exception:
-        return None
+    return await _authed_get(session, "/api/system", token)
 
 async def _fetch_nodes_usage(session: aiohttp.ClientSession, token: Optional[str], start: Optional[str] = None, end: Optional[str] = None) -> Optional[Dict[str, Any]]:
-    if not MARZBAN_URL:
-        return None
-    headers = {}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    params = {}
-    if start:
-        params["start"] = start
-    if end:
-        params["end"] = end
-    url = f"{MARZBAN_URL}/api/nodes/usage"
-    try:
-        async with session.get(url, headers=headers, params=params, timeout=aiohttp.ClientTimeout(total=15)) as resp:
-            if resp.status != 200:
-                return None
-            return await resp.json()
-    except Exception:
-        return None
+    return await _authed_get(session, "/api/nodes/usage", token, _range_params(start, end), _T15)
 
 async def _fetch_users_usage(session: aiohttp.ClientSession, token: Optional[str], start: Optional[str] = None, end: Optional[str] = None) -> Optional[List[Dict[str, Any]]]:
-    if not MARZBAN_URL:
-        return None
-    headers = {}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    params = {}
-    if start:
-        params["start"] = start
-    if end:
-        params["end"] = end
-    url = f"{MARZBAN_URL}/api/users/usage"
-    try:
-        async with session.get(url, headers=headers, params=params, timeout=aiohttp.ClientTimeout(total=20)) as resp:
-            if resp.status != 200:
-                return None
-            return await resp.json()
-    except Exception:
-        return None
+    return await _authed_get(session, "/api/users/usage", token, _range_params(start, end), _T20)
 
 def _build_node_base(node: Dict[str, Any]) -> str:
-    addr = node.get("address") or node.get("name") or ""
-    api_port = node.get("api_port")
+    return _node_base(node.get("address") or node.get("name") or "", node.get("api_port"), IP_AGENT_PORT)
+
+@functools.lru_cache(maxsize=512)
+def _node_base(addr: str, api_port: Any, ip_agent_port: str) -> str:
     if not addr:
         return ""
     if addr.startswith("http://") or addr.startswith("https://"):
         if ":" not in addr.split("://", 1)[1]:
             if api_port:
                 return f"{addr.rstrip('/')}:{api_port}"
-            if IP_AGENT_PORT:
-                return f"{addr.rstrip('/')}:{IP_AGENT_PORT}"
+            if ip_agent_port:
+                return f"{addr.rstrip('/')}:{ip_agent_port}"
         return addr.rstrip("/")
     if api_port:
         return f"http://{addr}:{api_port}"
-    if IP_AGENT_PORT:
-        return f"http://{addr}:{IP_AGENT_PORT}"
+    if ip_agent_port:
+        return f"http://{addr}:{ip_agent_port}"
     return f"http://{addr}"
 
-async def _try_node_path(session: aiohttp.ClientSession, base: str, path: str, timeout_s: int = 5) -> Optional[Any]:
+async def _try_node_path(session: aiohttp.ClientSession, base: str, path: str, timeout: aiohttp.ClientTimeout = _T5) -> Optional[Any]:
     url = f"{base.rstrip('/')}{path}"
     try:
-        async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout_s)) as resp:
+        async with session.get(url, headers=_NODE_HEADERS, timeout=timeout) as resp:
             if resp.status != 200:
                 return {"error": f"{resp.status} {resp.reason}"}
-            try:
-                return await resp.json()
-            except Exception:
-                text = await resp.text()
-                return {"raw": text}
+            if resp.content_type.startswith("application/json"):
+                body = await resp.read()
+                # пустое тело — как None у resp.json(): путь пропускается, а не считается рабочим
+                return orjson.loads(body) if body else None
+            return {"raw": await resp.text()}
     except Exception as ex:
-        return {"error": str(ex)}
+        # у TimeoutError пустой str(), а пустая ошибка выглядела бы как рабочий эндпоинт
+        return {"error": str(ex) or type(ex).__name__}
 
 def _normalize_node_response(data: Any) -> Dict[str, Any]:
-    clients: List[Any] = []
-    count = 0
-    if isinstance(data, list):
-        clients = data
-        count = len(clients)
-        return {"count": count, "clients": clients}
-    if isinstance(data, dict):
-        if "ips" in data and isinstance(data["ips"], list):
-            clients = data["ips"]
-            count = int(data.get("count", len(clients)))
-            return {"count": count, "clients": clients, "port": data.get("port"), "meta": {k: data.get(k) for k in ("count_ipv4_enabled", "count_ipv6_enabled", "trusted_ips_configured") if k in data}}
-        for key in ("clients", "connections", "peers", "addresses"):
-            if key in data and isinstance(data[key], list):
-                clients = data[key]
-                count = len(clients)
-                return {"count": count, "clients": clients}
-        if "count" in data and isinstance(data["count"], int):
+    t = type(data)
+    if t is list:
+        return {"count": len(data), "clients": data}
+    if t is dict:
+        ips = data.get("ips")
+        if type(ips) is list:
+            return {"count": int(data.get("count", len(ips))), "clients": ips, "port": data.get("port"), "meta": {k: data[k] for k in _META_KEYS if k in data}}
+        for key in _LIST_KEYS:
+            v = data.get(key)
+            if type(v) is list:
+                return {"count": len(v), "clients": v}
+        if isinstance(data.get("count"), int):
             return {"count": data["count"], "clients": []}
-        for k, v in data.items():
-            if isinstance(v, list):
-                clients = v
-                count = len(v)
-                return {"count": count, "clients": clients}
-    return {"count": count, "clients": clients}
+        for v in data.values():
+            if type(v) is list:
+                return {"count": len(v), "clients": v}
+    return {"count": 0, "clients": []}
 
 def _build_ip_agent_base(node: Dict[str, Any]) -> Optional[str]:
-    addr = node.get("address") or node.get("name") or ""
+    return _ip_agent_base(node.get("address") or node.get("name") or "", IP_AGENT_PORT, IP_AGENT_SCHEME)
+
+@functools.lru_cache(maxsize=512)
+def _ip_agent_base(addr: str, ip_agent_port: str, ip_agent_scheme: str) -> Optional[str]:
     if not addr:
         return None
     if addr.startswith("http://") or addr.startswith("https://"):
         host_part = addr.rstrip("/")
-        if ":" not in host_part.split("://", 1)[1] and IP_AGENT_PORT:
-            return f"{host_part}:{IP_AGENT_PORT}"
+        if ":" not in host_part.split("://", 1)[1] and ip_agent_port:
+            return f"{host_part}:{ip_agent_port}"
         return host_part
-    port = IP_AGENT_PORT or node.get("api_port")
-    scheme = IP_AGENT_SCHEME or "http"
-    if port:
-        return f"{scheme}://{addr}:{port}"
-    return f"{scheme}://{addr}"
-
-async def fetch_node_clients(session: aiohttp.ClientSession, node: Dict[str, Any]) -> Dict[str, Any]:
-    result = {"count": 0, "clients": [], "detected_path": None, "error": None}
-    base_ip_agent = _build_ip_agent_base(node)
-    if base_ip_agent:
-        res = await _try_node_path(session, base_ip_agent, "/connections", timeout_s=5)
-        if res is not None and not (isinstance(res, dict) and res.get("error")):
-            norm = _normalize_node_response(res)
-            if norm.get("count", 0) > 0 or len(norm.get("clients", [])) > 0 or isinstance(res, (list, dict)):
-                if isinstance(norm, dict) and "meta" in norm:
-                    result["meta"] = norm["meta"]
-                if isinstance(norm, dict) and "port" in norm:
-                    result["port"] = norm["port"]
-                result.update({"count": norm.get("count", 0), "clients": norm.get("clients", []), "detected_path": f"{base_ip_agent}/connections"})
-                return result
-    base = _build_node_base(node)
-    if not base:
-        result["error"] = "no base address"
+    if not ip_agent_port:
+        return None
+    scheme = ip_agent_scheme or "http"
+    return f"{scheme}://{addr}:{ip_agent_port}"
+
+def _node_timeout_result() -> Dict[str, Any]:
+    return {"count": None, "clients": [], "detected_path": None, "error": "timeout"}
+
+def _node_skipped_result(prev: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    # нода не дождалась слота в этом цикле: показываем прошлый результат, в следующем цикле она опрашивается первой
+    if prev is None:
+        return {"count": None, "clients": [], "detected_path": None, "error": "skipped"}
+    return {
+        "count": prev.get("clients_count"),
+        "clients": prev.get("clients", []),
+        "detected_path": prev.get("detected_path"),
+        "error": prev.get("clients_error"),
+        "port": prev.get("clients_port"),
+        "meta": prev.get("clients_meta"),
+    }
+
+def _probe_timeout(deadline: float, left: int, cap: float = 5.0) -> aiohttp.ClientTimeout:
+    # оставшееся время ноды делится поровну между непроверенными путями,
+    # чтобы молчащий ip_agent не съел время запасных путей ноды
+    remaining = deadline - asyncio.get_running_loop().time()
+    return aiohttp.ClientTimeout(total=max(min(cap, remaining / left), 0.1))
+
+async def fetch_node_clients(session: aiohttp.ClientSession, node: Dict[str, Any], started: Set[asyncio.Task], deadline: float) -> Dict[str, Any]:
+    # ограничиваем число нод, опрашиваемых одновременно, чтобы не забивать пул соединений,
+    # и время на одну ноду, чтобы медленная нода не держала слот семафора
+    async with _NODE_SEM:
+        # в started попадают задачи, дождавшиеся слота: остальные к концу цикла ноду даже не опрашивали
+        started.add(asyncio.current_task())
+        try:
+            deadline = min(deadline, asyncio.get_running_loop().time() + NODE_TIMEOUT)
+            return await asyncio.wait_for(_fetch_node_clients(session, node, deadline), timeout=NODE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return _node_timeout_result()
+
+async def _probe_node_path(session: aiohttp.ClientSession, base: str, path: str, detected_path: str, timeout: aiohttp.ClientTimeout = _T5) -> Optional[Dict[str, Any]]:
+    res = await _try_node_path(session, base, path, timeout)
+    if res is None or (isinstance(res, dict) and res.get("error")):
+        return None
+    norm = _normalize_node_response(res)
+    if norm.get("count", 0) > 0 or len(norm.get("clients", [])) > 0 or isinstance(res, (list, dict)):
+        result = {"count": norm.get("count", 0), "clients": norm.get("clients", []), "detected_path": detected_path, "error": None}
+        if "meta" in norm:
+            result["meta"] = norm["meta"]
+        if "port" in norm:
+            result["port"] = norm["port"]
         return result
+    return None
 
-    paths = []
-    cfg_path = node.get("clients_path")
-    if cfg_path:
-        paths.append(cfg_path)
-    for p in NODE_CANDIDATE_PATHS:
-        if p not in paths:
-            paths.append(p)
-
-    for p in paths:
-        res = await _try_node_path(session, base, p, timeout_s=5)
-        if res is None:
-            continue
-        if isinstance(res, dict) and res.get("error"):
-            continue
-        norm = _normalize_node_response(res)
-        if norm.get("count", 0) > 0 or len(norm.get("clients", [])) > 0 or isinstance(res, (list, dict)):
-            if isinstance(norm, dict) and "meta" in norm:
-                result["meta"] = norm["meta"]
-            if isinstance(norm, dict) and "port" in norm:
-                result["port"] = norm["port"]
-            result.update({"count": norm.get("count", 0), "clients": norm.get("clients", []), "detected_path": p})
-            return result
-
-    result["error"] = "no usable endpoint"
-    return result
+async def _fetch_node_clients(session: aiohttp.ClientSession, node: Dict[str, Any], deadline: float) -> Dict[str, Any]:
+    node_id = node.get("id")
+    # без IP_AGENT_PORT отдельного ip_agent нет: /connections и так проверяется среди путей ноды
+    base_ip_agent = _build_ip_agent_base(node) if IP_AGENT_PORT else None
+    base = _build_node_base(node)
+
+    # сначала пробуем путь, сработавший на прошлом опросе, остальные кандидаты — только если он отвалился
+    cached = _detected_path_cache.get(node_id) if node_id is not None else None
+    if cached and cached[0] in (base_ip_agent, base):
+        # короткий таймаут: как минимум половина времени ноды остаётся на перебор остальных путей
+        res = await _probe_node_path(session, *cached, timeout=_probe_timeout(deadline, 2, _CACHED_PATH_TIMEOUT))
+        if res is not None:
+            return res
+        _detected_path_cache.pop(node_id, None)
 
-def _parse_ss_output_for_remote_ips(output: str) -> List[str]:
+    candidates = []
+    if base_ip_agent:
+        candidates.append((base_ip_agent, "/connections", f"{base_ip_agent}/connections"))
+    if base:
+        cfg_path = node.get("clients_path")
+        paths = list(dict.fromkeys([cfg_path, *NODE_CANDIDATE_PATHS] if cfg_path else NODE_CANDIDATE_PATHS))
+        candidates.extend((base, p, p) for p in paths)
+
+    candidates = [c for c in candidates if c != cached]
+    for i, candidate in enumerate(candidates):
+        res = await _probe_node_path(session, *candidate, timeout=_probe_timeout(deadline, len(candidates) - i))
+        if res is not None:
+            if node_id is not None:
+                _detected_path_cache[node_id] = candidate
+            return res
+
+    return {"count": 0, "clients": [], "detected_path": None, "error": "no usable endpoint" if base else "no base address"}
+
+def _parse_ss_output_for_remote_ips(output: bytes) -> List[str]:
+    # один проход скомпилированного выражения по всему выводу ss вместо разбора каждой строки
+    return list({ip.decode() for ip in _PEER_RE.findall(output)})
+
+def _hex_to_ip(raw: bytes, family: int) -> str:
+    # ядро пишет адрес 32-битными словами в порядке байт хоста (little-endian)
+    packed = bytes.fromhex(raw.decode())
+    packed = b"".join(packed[i:i + 4][::-1] for i in range(0, len(packed), 4))
+    return socket.inet_ntop(family, packed)
+
+def _read_proc_net_remote_ips(port: int) -> List[str]:
     ips = set()
-    for line in output.splitlines():
-        line = line.strip()
-        if not line or line.lower().startswith("netid") or line.lower().startswith("state"):
-            continue
-        parts = re.split(r"\s+", line)
-        if len(parts) < 1:
+    found = False
+    for path, family in _PROC_NET_TCP:
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
             continue
-        peer = parts[-1]
-        m = re.match(r"^\[?([^\]]+?)\]?:(\d+)$", peer)
-        if m:
-            ip = m.group(1)
-            ips.add(ip)
-
-async def poll_loop():
-    async with aiohttp.ClientSession() as session:
-        while True:
-            try:
-                token = await _fetch_token(session)
-                tasks_master = [
-                    _fetch_nodes(session, token),
-                    _fetch_system(session, token),
-                    _fetch_nodes_usage(session, token),
-                    _fetch_users_usage(session, token),
-                ]
-                nodes, system_stat, nodes_usage, users_usage = await asyncio.gather(*tasks_master)
-                stats["system"] = system_stat
-                stats["nodes_usage"] = nodes_usage
-                stats["users_usage"] = users_usage
-
-                if nodes is None:
-                    stats["error"] = "failed to fetch nodes"
-                    stats["nodes"] = []
-                    stats["last_update"] = time.time()
-                    await asyncio.sleep(POLL_INTERVAL)
+        found = True
+        with f:
+            next(f, None)
+            for line in f:
+                parts = line.split()
+                if len(parts) < 4 or parts[3] in _PROC_TCP_SKIP_STATES:
                     continue
+                if int(parts[1].rpartition(b":")[2], 16) != port:
+                    continue
+                ips.add(_hex_to_ip(parts[2].rpartition(b":")[0], family))
+    if not found:
+        raise FileNotFoundError("/proc/net/tcp")
+    return list(ips)
 
-                node_entries: List[Dict[str, Any]] = []
-                for n in nodes:
-                    entry = {
-                        "id": n.get("id"),
-                        "name": n.get("name"),
-                        "address": n.get("address"),
-                        "api_port": n.get("api_port"),
-                        "status": n.get("status"),
-                        "message": n.get("message"),
-                        "clients_count": None,
-                        "clients": [],
-                        "detected_path": None,
-                        "clients_error": None,
-                        "uplink": None,
-                        "downlink": None,
-                    }
-                    node_entries.append(entry)
-
-                if nodes_usage and isinstance(nodes_usage, dict):
-                    usages = nodes_usage.get("usages") or []
-                    for entry in node_entries:
-                        for u in usages:
-                            if (entry["id"] is not None and u.get("node_id") == entry["id"]) or (u.get("node_name") and u.get("node_name") == entry.get("name")):
-                                entry["uplink"] = u.get("uplink")
-                                entry["downlink"] = u.get("downlink")
-                                break
-
-                tasks = [fetch_node_clients(session, n) for n in nodes]
-                clients_results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                for i, res in enumerate(clients_results):
-                    if isinstance(res, Exception):
-                        node_entries[i]["clients_error"] = str(res)
-                        node_entries[i]["clients_count"] = None
-                        continue
-                    node_entries[i]["clients_count"] = res.get("count", 0)
-                    node_entries[i]["clients"] = res.get("clients", [])
-                    node_entries[i]["detected_path"] = res.get("detected_path")
-                    node_entries[i]["clients_error"] = res.get("error")
-                    if res.get("port") is not None:
-                        node_entries[i]["clients_port"] = res.get("port")
-                    if res.get("meta") is not None:
-                        node_entries[i]["clients_meta"] = res.get("meta")
-
-                stats["nodes"] = node_entries
-
+async def get_unique_remote_ips(port: int) -> List[str]:
+    # таблицу соединений читаем прямо из /proc, ss запускаем только там, где её нет
+    try:
+        return await asyncio.to_thread(_read_proc_net_remote_ips, port)
+    except OSError:
+        pass
+    proc = await asyncio.create_subprocess_exec(
+        "ss", "-Htn", "state", "connected", f"sport = :{port}",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await proc.communicate()
+    return _parse_ss_output_for_remote_ips(stdout)
+
+def _publish_stats(new_stats: Dict[str, Any]) -> None:
+    # снимок подменяется целиком одной операцией, читатели никогда не видят наполовину обновлённые данные;
+    # /api/stats отдаёт одни и те же байты всем клиентам до следующего цикла опроса
+    global stats
+    try:
+        body = orjson.dumps(new_stats, option=_ORJSON_OPTS)
+    except orjson.JSONEncodeError as ex:
+        # orjson.loads принимает больше, чем может выдать dumps (например, вложенность глубже 255):
+        # один такой ответ ноды не должен останавливать опрос, публикуем только ошибку
+        new_stats = {
+            "nodes": [],
+            "last_update": new_stats.get("last_update"),
+            "error": f"failed to encode stats: {ex}",
+            "system": None,
+            "nodes_usage": None,
+            "users_usage": None,
+            "port_8443": {"unique_clients": 0, "clients": []},
+        }
+        body = orjson.dumps(new_stats, option=_ORJSON_OPTS)
+    stats = new_stats
+    _stats_json_cache["body"] = body
+
+async def poll_loop(session: aiohttp.ClientSession):
+    for cycle in itertools.count():
+        new_stats = dict(stats)
+        try:
+            token = await _fetch_token(session)
+            try:
+                nodes = await _fetch_nodes(session, token)
+            except Exception:
+                nodes = None
+            # тяжёлые эндпоинты статистики опрашиваются реже, между опросами в stats остаётся прошлое значение
+            tasks_master = {"system": _fetch_system(session, token)}
+            if cycle % _NODES_USAGE_EVERY == 0 or "nodes_usage" in _usage_retry:
+                tasks_master["nodes_usage"] = _fetch_nodes_usage(session, token)
+            if cycle % _USERS_USAGE_EVERY == 0 or "users_usage" in _usage_retry:
+                tasks_master["users_usage"] = _fetch_users_usage(session, token)
+            tasks_master["port"] = get_unique_remote_ips(MONITOR_PORT)
+            # опрос нод зависит только от списка нод, поэтому идёт параллельно с остальными запросами к master
+            master_future = asyncio.gather(*tasks_master.values(), return_exceptions=True)
+            # на весь опрос нод отводится часть интервала: зависшие ноды отменяются, а не растягивают цикл;
+            # ошибка одной ноды не трогает остальные
+            # слоты семафора выдаются в порядке создания задач, поэтому начало очереди сдвигается по кругу:
+            # зависшие ноды в начале списка не могут навсегда занять слоты остальных
+            nodes_list = nodes or []
+            offset = _node_rotation["offset"] % len(nodes_list) if nodes_list else 0
+            started: Set[asyncio.Task] = set()
+            deadline = asyncio.get_running_loop().time() + _NODE_POLL_BUDGET
+            tasks_by_index = {i: asyncio.create_task(fetch_node_clients(session, nodes_list[i], started, deadline))
+                              for i in itertools.chain(range(offset, len(nodes_list)), range(offset))}
+            node_tasks = [tasks_by_index[i] for i in range(len(nodes_list))]
+            pending: Set[asyncio.Task] = set()
+            if node_tasks:
                 try:
-                    unique_ips = await asyncio.to_thread(get_unique_remote_ips, MONITOR_PORT)
-                    stats["port_8443"] = {"unique_clients": len(unique_ips), "clients": unique_ips[:200]}
-                except Exception:
-                    stats["port_8443"] = {"unique_clients": 0, "clients": []}
-
-                stats["error"] = None
-                stats["last_update"] = time.time()
-            except Exception as ex:
-                stats["error"] = str(ex)
-                stats["nodes"] = []
-                stats["last_update"] = time.time()
-            await asyncio.sleep(POLL_INTERVAL)
+                    _, pending = await asyncio.wait(node_tasks, timeout=_NODE_POLL_BUDGET)
+                except asyncio.CancelledError:
+                    # при остановке приложения ни опросы нод, ни запросы к master не должны пережить цикл
+                    for t in node_tasks:
+                        t.cancel()
+                    master_future.cancel()
+                    # дожидаемся отмены, чтобы ничего не обратилось к сессии после её закрытия
+                    await asyncio.gather(master_future, *node_tasks, return_exceptions=True)
+                    raise
+            probing = pending & started
+            _node_rotation["offset"] = offset + len(started)
+            for t in pending:
+                t.cancel()
+            if pending:
+                await asyncio.wait(pending)
+            gathered = await master_future
+            results = {k: (None if isinstance(v, BaseException) else v) for k, v in zip(tasks_master, gathered)}
+            prev_by_id = {e["id"]: e for e in stats.get("nodes") or [] if e.get("id") is not None}
+            clients_results = [
+                (_node_timeout_result() if t in probing else _node_skipped_result(prev_by_id.get(n.get("id")))) if t in pending
+                else t.exception() or t.result()
+                for n, t in zip(nodes_list, node_tasks)
+            ]
+            new_stats["system"] = results["system"]
+            for key in ("nodes_usage", "users_usage"):
+                if key not in results:
+                    continue
+                if results[key] is None:
+                    _usage_retry.add(key)
+                else:
+                    _usage_retry.discard(key)
+                    new_stats[key] = results[key]
+            nodes_usage = new_stats["nodes_usage"]
+            unique_ips = results["port"]
+            if unique_ips is not None:
+                new_stats["port_8443"] = {"unique_clients": len(unique_ips), "clients": unique_ips[:200]}
+            else:
+                new_stats["port_8443"] = {"unique_clients": 0, "clients": []}
+
+            if nodes is None:
+                new_stats["error"] = "failed to fetch nodes"
+                new_stats["nodes"] = []
+                new_stats["last_update"] = time.time()
+                _publish_stats(new_stats)
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+
+            node_entries: List[Dict[str, Any]] = []
+            for n in nodes:
+                entry = {
+                    "id": n.get("id"),
+                    "name": n.get("name"),
+                    "address": n.get("address"),
+                    "api_port": n.get("api_port"),
+                    "status": n.get("status"),
+                    "message": n.get("message"),
+                    "clients_count": None,
+                    "clients": [],
+                    "detected_path": None,
+                    "clients_error": None,
+                    "uplink": None,
+                    "downlink": None,
+                }
+                node_entries.append(entry)
+            # ноды, пропавшие из master, не держат запись в кэше найденных путей
+            for node_id in _detected_path_cache.keys() - {e["id"] for e in node_entries}:
+                del _detected_path_cache[node_id]
+
+            if nodes_usage and isinstance(nodes_usage, dict):
+                usages = nodes_usage.get("usages") or []
+                by_id = {u.get("node_id"): u for u in usages if u.get("node_id") is not None}
+                by_name = {u.get("node_name"): u for u in usages if u.get("node_name")}
+                for entry in node_entries:
+                    u = (by_id.get(entry["id"]) if entry["id"] is not None else None) or by_name.get(entry.get("name"))
+                    if u:
+                        entry["uplink"] = u.get("uplink")
+                        entry["downlink"] = u.get("downlink")
+
+            for i, res in enumerate(clients_results):
+                if isinstance(res, Exception):
+                    node_entries[i]["clients_error"] = str(res)
+                    node_entries[i]["clients_count"] = None
+                    continue
+                node_entries[i]["clients_count"] = res.get("count", 0)
+                node_entries[i]["clients"] = res.get("clients", [])
+                node_entries[i]["detected_path"] = res.get("detected_path")
+                node_entries[i]["clients_error"] = res.get("error")
+                if res.get("port") is not None:
+                    node_entries[i]["clients_port"] = res.get("port")
+                if res.get("meta") is not None:
+                    node_entries[i]["clients_meta"] = res.get("meta")
+
+            new_stats["nodes"] = node_entries
+            new_stats["error"] = None
+            new_stats["last_update"] = time.time()
+            _publish_stats(new_stats)
+        except Exception as ex:
+            new_stats["error"] = str(ex)
+            new_stats["nodes"] = []
+            new_stats["last_update"] = time.time()
+            _publish_stats(new_stats)
+        await asyncio.sleep(POLL_INTERVAL)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     if not MARZBAN_URL:
         stats["error"] = "MARZBAN_URL not configured"
-    task = asyncio.create_task(poll_loop())
+    _publish_stats(stats)
+    # одна сессия на всё время жизни приложения: пул соединений общий для опроса и обработчиков
+    connector = aiohttp.TCPConnector(limit=IP_AGENT_CONN_LIMIT, limit_per_host=8, keepalive_timeout=75, ttl_dns_cache=300, enable_cleanup_closed=True)
+    app.state.http = aiohttp.ClientSession(connector=connector, timeout=_T10)
+    task = asyncio.create_task(poll_loop(app.state.http))
     try:
         yield
     finally:
@@ -364,89 +555,39 @@ async def lifespan(app: FastAPI):
             await task
         except asyncio.CancelledError:
             pass
+        await app.state.http.close()
+
+_BYTE_UNITS = ('Б', 'КБ', 'МБ', 'ГБ', 'ТБ', 'ПБ', 'ЭБ')
 
+@functools.lru_cache(maxsize=2048)
 def human_bytes(num: Optional[int]) -> str:
     if num is None:
         return "—"
-    for unit in ['Б', 'КБ', 'МБ', 'ГБ', 'ТБ', 'ПБ']:
-        if abs(num) < 1024.0:
-            if unit == 'Б':
-                return f"{num} {unit}"
-            return f"{num:.2f} {unit}"
-        num /= 1024.0
-    return f"{num:.2f} ЭБ"
-
-def get_usage_range(period: str) -> tuple[Optional[str], Optional[str]]:
-    now = datetime.utcnow()
-    if period == "1d":
-        start = (now - timedelta(days=1)).isoformat(timespec="seconds") + "Z"
-    elif period == "1w":
-        start = (now - timedelta(weeks=1)).isoformat(timespec="seconds") + "Z"
-    elif period == "1m":
-        start = (now - timedelta(days=30)).isoformat(timespec="seconds") + "Z"
-    else:
+    a = abs(num)
+    if a < 1024:
+        return f"{num} Б"
+    # номер единицы по числу бит вместо цикла с делением
+    i = min((int(a).bit_length() - 1) // 10, 6)
+    return f"{num / (1 << (i * 10)):.2f} {_BYTE_UNITS[i]}"
+
+_USAGE_PERIODS = {"1d": timedelta(days=1), "1w": timedelta(weeks=1), "1m": timedelta(days=30)}
+
+def get_usage_range(period: str) -> Tuple[Optional[str], Optional[str]]:
+    delta = _USAGE_PERIODS.get(period)
+    if delta is None:
         return (None, None)
-    return (start, now.isoformat(timespec="seconds") + "Z")
-
-APP = FastAPI(lifespan=lifespan)
-
-@APP.get("/api/stats")
-async def api_stats():
-    return JSONResponse(content=stats)
-
-@APP.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    nodes = stats.get("nodes", [])
-    last = stats.get("last_update")
-    err = stats.get("error")
-    system = stats.get("system")
-    port_info = stats.get("port_8443", {})
-    last_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last)) if last else "—"
-
-    # суммарное количество активных клиентов по всем нодам
-    total_clients = sum(int(n.get('clients_count') or 0) for n in nodes)
-
-    header = f"""
-    <div class="mb-3 d-flex flex-wrap align-items-center">
-        <span class="badge bg-secondary">Последнее обновление: {last_str}</span>
-        <span class="badge bg-info text-dark ms-2">Подключений к порту {MONITOR_PORT}: {port_info.get('unique_clients', '—')}</span>
-        <span class="badge bg-dark ms-2">Активных клиентов: {total_clients}</span>
-    </div>
-    """
-    if system:
-        header += f"""
-        <div class="mb-3">
-            <span class="badge bg-success">Online users (master): {system.get('online_users', '—')}</span>
-            <span class="badge bg-primary ms-2">Incoming bandwidth: {human_bytes(system.get('incoming_bandwidth'))}</span>
-            <span class="badge bg-primary ms-2">Outgoing bandwidth: {human_bytes(system.get('outgoing_bandwidth'))}</span>
-        </div>
-        """
+    cached = _range_cache.get(period)
+    if cached and time.monotonic() - cached[0] < 1.0:
+        return cached[1]
+    now = datetime.now(timezone.utc)
+    result = ((now - delta).strftime("%Y-%m-%dT%H:%M:%SZ"), now.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    _range_cache[period] = (time.monotonic(), result)
+    return result
 
-    items = ""
-    for n in nodes:
-        items += f"""
-        <div class="col">
-            <div class="card shadow-sm mb-4">
-                <div class="card-header bg-light">
-                    <b>{n.get('name') or n.get('address')}</b>
-                </div>
-                <div class="card-body">
-                    <ul class="list-group list-group-flush">
-                        <li class="list-group-item"><b>Address:</b> {n.get('address') or '—'}</li>
-                        <li class="list-group-item"><b>API port:</b> {n.get('api_port') or '—'}</li>
-                        <li class="list-group-item"><b>Status:</b> {n.get('status') or '—'}</li>
-                        <li class="list-group-item"><b>Clients:</b> {n.get('clients_count') if n.get('clients_count') is not None else '—'}</li>
-                        <li class="list-group-item"><b>Uplink:</b> {human_bytes(n.get('uplink'))} <b>Downlink:</b> {human_bytes(n.get('downlink'))}</li>
-                    </ul>
-                    {"<div class='alert alert-danger mt-2'>Clients error: " + n.get('clients_error') + "</div>" if n.get('clients_error') else ""}
-                </div>
-            </div>
-        </div>
-        """
-    if not items:
-        items = "<div class='alert alert-warning'>Ноды не обнаружены.</div>"
+_RELOAD_MS = int(POLL_INTERVAL * 1000)
 
-    html = f"""<!doctype html>
+# неизменяемые части страницы собираются один раз при импорте
+_HTML_HEAD = """<!doctype html>
 <html lang="ru">
 <head>
     <meta charset="utf-8">
@@ -458,10 +599,9 @@ async def index(request: Request):
 <body class="bg-light">
 <div class="container py-4">
     <h1 class="mb-4">Marzban — Ноды</h1>
-    {header}
-    <div style="color:#b00">{err or ''}</div>
-    <div class="row row-cols-1 row-cols-md-2 row-cols-lg-3 g-4">
-        {items}
+"""
+
+_HTML_TAIL = """
     </div>
 </div>
 
@@ -473,12 +613,178 @@ async def index(request: Request):
 </a>
 
 <script>
-setTimeout(()=>location.reload(), {int(POLL_INTERVAL*1000)});
+// страница загружается один раз, дальше обновляем только значения из /api/stats;
+// если набор нод поменялся — перезагружаем страницу целиком
+const UNITS = ['Б', 'КБ', 'МБ', 'ГБ', 'ТБ', 'ПБ'];
+function humanBytes(num) {
+    if (num === null || num === undefined) return '—';
+    for (const unit of UNITS) {
+        if (Math.abs(num) < 1024) return unit === 'Б' ? `${num} ${unit}` : `${num.toFixed(2)} ${unit}`;
+        num /= 1024;
+    }
+    return `${num.toFixed(2)} ЭБ`;
+}
+function pad(n) { return String(n).padStart(2, '0'); }
+function fmtTime(ts) {
+    if (!ts) return '—';
+    const d = new Date(ts * 1000);
+    return `${d.getFullYear()}-${pad(d.getMonth() + 1)}-${pad(d.getDate())} ${pad(d.getHours())}:${pad(d.getMinutes())}:${pad(d.getSeconds())}`;
+}
+function setText(el, value) { if (el) el.textContent = value; }
+function patch(s) {
+    const nodes = s.nodes || [];
+    const cards = document.querySelectorAll('[data-node-id]');
+    const hasSystem = !!document.getElementById('online-users');
+    if (cards.length !== nodes.length || hasSystem !== !!s.system
+        || nodes.some((n, i) => cards[i].dataset.nodeId !== String(n.id ?? ''))) {
+        location.reload();
+        return;
+    }
+    setText(document.getElementById('last-update'), fmtTime(s.last_update));
+    setText(document.getElementById('port-clients'), (s.port_8443 || {}).unique_clients ?? '—');
+    setText(document.getElementById('total-clients'), nodes.reduce((acc, n) => acc + (parseInt(n.clients_count) || 0), 0));
+    if (s.system) {
+        setText(document.getElementById('online-users'), s.system.online_users ?? '—');
+        setText(document.getElementById('incoming-bandwidth'), humanBytes(s.system.incoming_bandwidth));
+        setText(document.getElementById('outgoing-bandwidth'), humanBytes(s.system.outgoing_bandwidth));
+    }
+    setText(document.getElementById('poll-error'), s.error || '');
+    nodes.forEach((n, i) => {
+        const card = cards[i];
+        setText(card.querySelector('.node-status'), n.status || '—');
+        setText(card.querySelector('.node-clients'), n.clients_count ?? '—');
+        setText(card.querySelector('.node-uplink'), humanBytes(n.uplink));
+        setText(card.querySelector('.node-downlink'), humanBytes(n.downlink));
+        const err = card.querySelector('.node-error');
+        err.hidden = !n.clients_error;
+        setText(err.querySelector('span'), n.clients_error || '');
+    });
+}
+setInterval(async () => {
+    try {
+        const r = await fetch('/api/stats', {cache: 'no-cache'});
+        if (r.ok) patch(await r.json());
+    } catch (e) {}
+}, %d);
 </script>
 </body>
-</html>"""
-    return HTMLResponse(content=html)
+</html>""" % _RELOAD_MS
+
+_HEADER_TMPL = """
+    <div class="mb-3 d-flex flex-wrap align-items-center">
+        <span class="badge bg-secondary">Последнее обновление: <span id="last-update">{last_str}</span></span>
+        <span class="badge bg-info text-dark ms-2">Подключений к порту %d: <span id="port-clients">{port_clients}</span></span>
+        <span class="badge bg-dark ms-2">Активных клиентов: <span id="total-clients">{total_clients}</span></span>
+    </div>
+    """ % MONITOR_PORT
+
+_SYSTEM_TMPL = """
+        <div class="mb-3">
+            <span class="badge bg-success">Online users (master): <span id="online-users">{online_users}</span></span>
+            <span class="badge bg-primary ms-2">Incoming bandwidth: <span id="incoming-bandwidth">{incoming}</span></span>
+            <span class="badge bg-primary ms-2">Outgoing bandwidth: <span id="outgoing-bandwidth">{outgoing}</span></span>
+        </div>
+        """
+
+_BODY_TMPL = """
+    <div id="poll-error" style="color:#b00">{err}</div>
+    <div class="row row-cols-1 row-cols-md-2 row-cols-lg-3 g-4">
+        """
+
+_CARD_TMPL = """
+        <div class="col">
+            <div class="card shadow-sm mb-4" data-node-id="{node_id}">
+                <div class="card-header bg-light">
+                    <b>{title}</b>
+                </div>
+                <div class="card-body">
+                    <ul class="list-group list-group-flush">
+                        <li class="list-group-item"><b>Address:</b> {address}</li>
+                        <li class="list-group-item"><b>API port:</b> {api_port}</li>
+                        <li class="list-group-item"><b>Status:</b> <span class="node-status">{status}</span></li>
+                        <li class="list-group-item"><b>Clients:</b> <span class="node-clients">{clients}</span></li>
+                        <li class="list-group-item"><b>Uplink:</b> <span class="node-uplink">{uplink}</span> <b>Downlink:</b> <span class="node-downlink">{downlink}</span></li>
+                    </ul>
+                    <div class='alert alert-danger mt-2 node-error'{error_hidden}>Clients error: <span>{error}</span></div>
+                </div>
+            </div>
+        </div>
+        """
+
+def _card(n: Dict[str, Any]) -> str:
+    # данные нод приходят из master API и с самих нод, поэтому экранируем всё, что выводим
+    clients_error = n.get('clients_error')
+    return _CARD_TMPL.format_map({
+        "node_id": escape(str(n.get('id') if n.get('id') is not None else '')),
+        "title": escape(str(n.get('name') or n.get('address'))),
+        "address": escape(str(n.get('address') or '—')),
+        "api_port": escape(str(n.get('api_port') or '—')),
+        "status": escape(str(n.get('status') or '—')),
+        "clients": n.get('clients_count') if n.get('clients_count') is not None else '—',
+        "uplink": human_bytes(n.get('uplink')),
+        "downlink": human_bytes(n.get('downlink')),
+        "error": escape(str(clients_error)) if clients_error else "",
+        "error_hidden": "" if clients_error else " hidden",
+    })
+
+class ORJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=_ORJSON_OPTS)
+
+APP = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+def _cache_headers(last: Optional[float]) -> Dict[str, str]:
+    # данные меняются только раз в цикл опроса, поэтому ETag привязан к времени последнего обновления
+    return {"ETag": f'W/"{int((last or 0) * 1000)}"', "Cache-Control": f"max-age={int(POLL_INTERVAL)}"}
+
+def _not_modified(request: Request, headers: Dict[str, str]) -> bool:
+    return request.headers.get("if-none-match") == headers["ETag"]
+
+@APP.get("/api/stats")
+async def api_stats(request: Request):
+    headers = _cache_headers(stats.get("last_update"))
+    if _not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    return Response(content=_stats_json_cache["body"], media_type=ORJSONResponse.media_type, headers=headers)
+
+@APP.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    snap = stats
+    last = snap.get("last_update")
+    headers = _cache_headers(last)
+    if _not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    # страница меняется только после очередного опроса, отдаём закэшированную
+    if _html_cache["html"] and _html_cache["last_update"] == last:
+        return HTMLResponse(content=_html_cache["html"], headers=headers)
+
+    nodes = snap.get("nodes", [])
+    err = snap.get("error")
+    system = snap.get("system")
+    port_info = snap.get("port_8443", {})
+    last_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last)) if last else "—"
+
+    # суммарное количество активных клиентов по всем нодам
+    total_clients = sum(int(n.get('clients_count') or 0) for n in nodes)
+
+    parts = [_HTML_HEAD, _HEADER_TMPL.format(last_str=last_str, port_clients=port_info.get('unique_clients', '—'), total_clients=total_clients)]
+    if system:
+        parts.append(_SYSTEM_TMPL.format(
+            online_users=system.get('online_users', '—'),
+            incoming=human_bytes(system.get('incoming_bandwidth')),
+            outgoing=human_bytes(system.get('outgoing_bandwidth')),
+        ))
+    parts.append(_BODY_TMPL.format(err=escape(str(err or ''))))
+    parts.extend(_card(n) for n in nodes)
+    if not nodes:
+        parts.append("<div class='alert alert-warning'>Ноды не обнаружены.</div>")
+    parts.append(_HTML_TAIL)
+    html = "".join(parts)
+    _html_cache.update({"last_update": last, "html": html})
+    return HTMLResponse(content=html, headers=headers)
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run("marz_balancer:APP", host="0.0.0.0", port=APP_PORT, reload=True)
\ No newline at end of file
+    uvicorn.run("marz_balancer:APP", host="0.0.0.0", port=APP_PORT, loop="uvloop", reload=APP_RELOAD)
\ No newline at end of file